@@ -25,6 +25,37 @@ class Settings(BaseSettings):
     # Modelo de Hugging Face para fallback
     HF_MODEL: str = "HuggingFaceH4/zephyr-7b-beta"
     
+    # Pool de workers para procesamiento de imágenes (CPU-bound)
+    IMAGE_WORKERS: int = 4
+    
+    # Preprocesamiento de la foto antes de subirla a Fal
+    FAL_UPLOAD_MAX_SIDE: int = 1024
+    FAL_UPLOAD_CACHE_SIZE: int = 64
+    
+    # Tiempo máximo (cola + inferencia) por endpoint de Fal, en segundos
+    FAL_ENDPOINT_TIMEOUT: float = 60.0
+    
+    # Captions sobre stickers: fuente (ruta a .ttf) y tamaño del atlas de glifos
+    CAPTION_FONT_PATH: Optional[str] = None
+    CAPTION_ATLAS_SIZE: int = 2048
+    # Longitud máxima del caption aceptado por la API (caracteres)
+    CAPTION_MAX_LENGTH: int = 100
+    
+    # Almacén local de stickers generados (direccionado por contenido);
+    # una ruta relativa se resuelve contra backend/
+    BLOB_STORE_DIR: str = "data/stickers"
+    BLOB_STORE_MAX_BYTES: int = 512 * 1024 * 1024
+    
+    # Tiempo máximo por request en segundos (el cliente puede pedir menos con
+    # el header X-Request-Deadline-Ms)
+    REQUEST_TIMEOUT: float = 120.0
+    
+    # Profiling por request (requiere pyinstrument). Desactivado si no hay token ni muestreo
+    PROFILING_TOKEN: Optional[str] = None
+    PROFILING_SAMPLE_RATE: float = 0.0
+    PROFILING_INTERVAL: float = 0.001
+    PROFILING_DIR: str = "data/profiles"
+    
     class Config:
         env_file = ".env"
         case_sensitive = True
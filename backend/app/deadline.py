@@ -0,0 +1,260 @@
+"""
+Deadlines por request y cancelación cuando el cliente se desconecta.
+
+Cada request recibe un Deadline (header X-Request-Deadline-Ms o REQUEST_TIMEOUT por
+defecto) que viaja en un ContextVar. Cada etapa (descargas, upload y cola de Fal,
+trabajos del pool de imágenes) usa stage_timeout() para limitar su propio timeout al
+tiempo que le queda al request. Si el cliente se desconecta o vence el deadline,
+el middleware cancela el handler y con él las llamadas pendientes.
+"""
+import asyncio
+import json
+import threading
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from fastapi import HTTPException
+
+from app import metrics
+from app.config import settings
+
+
+DEADLINE_HEADER = b"x-request-deadline-ms"
+
+
+class DeadlineError(HTTPException):
+    """Base de los errores por deadline vencido o request abandonado."""
+
+
+class DeadlineExceeded(DeadlineError):
+    """El request superó su tiempo máximo."""
+
+    def __init__(self):
+        super().__init__(status_code=504, detail="Tiempo máximo del request excedido")
+
+
+class RequestCancelled(DeadlineError):
+    """El cliente abandonó el request."""
+
+    def __init__(self):
+        # 499: "Client Closed Request" (convención de nginx)
+        super().__init__(status_code=499, detail="Request cancelado por el cliente")
+
+
+class Deadline:
+    """Momento límite de un request (reloj monotónico) más una marca de cancelación."""
+
+    def __init__(self, timeout: float):
+        self.expires_at = time.monotonic() + timeout
+        # threading.Event: se consulta también desde los hilos del pool de imágenes
+        self._cancelled = threading.Event()
+
+    def remaining(self) -> float:
+        """Segundos que le quedan al request (puede ser negativo)."""
+        return self.expires_at - time.monotonic()
+
+    def cancel(self) -> None:
+        """Marca el request como abandonado."""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def check(self) -> None:
+        """Lanza RequestCancelled o DeadlineExceeded si ya no tiene sentido seguir."""
+        if self.cancelled:
+            raise RequestCancelled()
+        if self.remaining() <= 0:
+            raise DeadlineExceeded()
+
+
+_current_deadline: ContextVar[Optional[Deadline]] = ContextVar("request_deadline", default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    """Deadline del request actual (None fuera de un request)."""
+    return _current_deadline.get()
+
+
+def check_deadline() -> None:
+    """Comprueba el deadline del request actual, si lo hay."""
+    deadline = _current_deadline.get()
+    if deadline is not None:
+        deadline.check()
+
+
+def remaining_time() -> Optional[float]:
+    """Segundos restantes del request actual, o None si no hay deadline."""
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return None
+    deadline.check()
+    return deadline.remaining()
+
+
+def stage_timeout(default: float) -> float:
+    """
+    Timeout para una etapa: su valor por defecto, limitado a lo que le queda al request.
+
+    Args:
+        default: Timeout propio de la etapa en segundos
+
+    Returns:
+        Timeout efectivo en segundos
+
+    Raises:
+        DeadlineError: Si el request ya venció o fue cancelado
+    """
+    remaining = remaining_time()
+    if remaining is None:
+        return default
+    return min(default, remaining)
+
+
+class DeadlineMiddleware:
+    """Middleware ASGI que asigna el deadline y cancela el handler si se abandona."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        deadline = Deadline(self._timeout(scope))
+        body_done = asyncio.Event()
+        disconnected = asyncio.Event()
+        response_started = False
+        response_complete = False
+
+        # Sin body (GET y compañía) el handler puede no llamar nunca a receive(): el
+        # watcher empieza ya y al handler se le entrega un body vacío si lo pide
+        empty_body_pending = not self._has_body(scope)
+        if empty_body_pending:
+            body_done.set()
+
+        async def wrapped_receive():
+            nonlocal empty_body_pending
+            if empty_body_pending:
+                empty_body_pending = False
+                return {"type": "http.request", "body": b"", "more_body": False}
+            # Una vez leído el body, receive() lo consume el watcher de desconexión
+            if body_done.is_set():
+                await disconnected.wait()
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+            elif not message.get("more_body", False):
+                body_done.set()
+            return message
+
+        async def wrapped_send(message):
+            nonlocal response_started, response_complete
+            if message["type"] == "http.response.start":
+                response_started = True
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                response_complete = True
+            await send(message)
+
+        async def watch_disconnect():
+            await body_done.wait()
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    disconnected.set()
+                    return not response_complete
+
+        context_token = _current_deadline.set(deadline)
+        try:
+            # El task hereda el contexto con el deadline
+            app_task = asyncio.create_task(self.app(scope, wrapped_receive, wrapped_send))
+        finally:
+            _current_deadline.reset(context_token)
+        watcher = asyncio.create_task(watch_disconnect())
+
+        try:
+            done, _ = await asyncio.wait(
+                {app_task, watcher},
+                timeout=max(0.0, deadline.remaining()),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+        except asyncio.CancelledError:
+            deadline.cancel()
+            app_task.cancel()
+            watcher.cancel()
+            raise
+
+        if app_task in done:
+            watcher.cancel()
+            # Propaga la excepción del handler, si la hubo
+            app_task.result()
+            return
+
+        if watcher in done and not watcher.result():
+            # Desconexión tras completar la respuesta (uvicorn la reporta siempre):
+            # el handler puede seguir con su trabajo post-respuesta (cerrar uploads,
+            # BackgroundTasks), así que solo se espera a que termine
+            await app_task
+            return
+
+        if watcher in done:
+            metrics.increment("requests_cancelled_disconnect")
+            print(f"Cliente desconectado, cancelando {scope['method']} {scope['path']}")
+        else:
+            # asyncio.wait venció sin que terminara nada: deadline excedido
+            watcher.cancel()
+            metrics.increment("requests_deadline_exceeded")
+            print(f"Deadline excedido, cancelando {scope['method']} {scope['path']}")
+
+        # Los workers del pool ven la marca en su siguiente comprobación
+        deadline.cancel()
+        app_task.cancel()
+        try:
+            await app_task
+        except asyncio.CancelledError:
+            pass
+
+        if not response_started and not disconnected.is_set():
+            await self._send_timeout(send)
+
+    @staticmethod
+    def _has_body(scope) -> bool:
+        """Indica si el request trae body (Content-Length no nulo o Transfer-Encoding)."""
+        for name, value in scope.get("headers", []):
+            if name == b"transfer-encoding":
+                return True
+            if name == b"content-length":
+                return value.strip() not in (b"", b"0")
+        return False
+
+    @staticmethod
+    def _timeout(scope) -> float:
+        """Timeout del request: el del header del cliente, limitado por REQUEST_TIMEOUT."""
+        for name, value in scope.get("headers", []):
+            if name == DEADLINE_HEADER:
+                try:
+                    requested = float(value) / 1000
+                except ValueError:
+                    break
+                if requested > 0:
+                    return min(requested, settings.REQUEST_TIMEOUT)
+                break
+        return settings.REQUEST_TIMEOUT
+
+    @staticmethod
+    async def _send_timeout(send) -> None:
+        """Responde 504 con el mismo formato que HTTPException."""
+        body = json.dumps({"detail": DeadlineExceeded().detail}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 504,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
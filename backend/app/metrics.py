@@ -0,0 +1,22 @@
+"""
+Contadores en memoria para métricas básicas del servidor.
+"""
+import threading
+from collections import Counter
+from typing import Dict
+
+
+_counters: Counter = Counter()
+_lock = threading.Lock()
+
+
+def increment(name: str, value: int = 1) -> None:
+    """Incrementa un contador (thread-safe: se usa también desde los workers)."""
+    with _lock:
+        _counters[name] += value
+
+
+def snapshot() -> Dict[str, int]:
+    """Devuelve una copia de todos los contadores."""
+    with _lock:
+        return dict(_counters)
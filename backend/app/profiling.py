@@ -0,0 +1,167 @@
+"""
+Profiling opcional por request (pyinstrument) con salida en formato speedscope.
+
+Dos modos, ambos desactivados por defecto:
+- Bajo demanda: header X-Profile con el valor de PROFILING_TOKEN (nunca en la URL,
+  que acaba en los logs de acceso y de los proxies). La respuesta indica el archivo
+  generado en el header X-Profile-File.
+- Muestreo aleatorio: una fracción PROFILING_SAMPLE_RATE de los requests, sin que el
+  cliente lo note.
+
+Cada profile cubre el handler async y el trabajo enviado al pool de imágenes, y se
+escribe como un único JSON de speedscope (https://www.speedscope.app) en PROFILING_DIR.
+"""
+import asyncio
+import json
+import random
+import secrets
+import time
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Callable, List, Optional, Tuple
+
+from app.config import settings
+
+
+PROFILE_HEADER = b"x-profile"
+PROFILE_FILE_HEADER = b"x-profile-file"
+
+# Sesiones de los workers del request que se está perfilando (None si no se perfila)
+_worker_sessions: ContextVar[Optional[List[Tuple[str, Any]]]] = ContextVar(
+    "profiling_worker_sessions", default=None
+)
+
+
+def profiling_enabled() -> bool:
+    """Indica si algún modo de profiling está configurado."""
+    return bool(settings.PROFILING_TOKEN) or settings.PROFILING_SAMPLE_RATE > 0
+
+
+def wrap_for_profiling(func: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Envuelve una función que se va a ejecutar en un worker para perfilarla también.
+
+    Si el request actual no se está perfilando devuelve la función tal cual.
+    """
+    sessions = _worker_sessions.get()
+    if sessions is None:
+        return func
+
+    def profiled(*args: Any, **kwargs: Any) -> Any:
+        from pyinstrument import Profiler
+
+        profiler = Profiler(interval=settings.PROFILING_INTERVAL, async_mode="disabled")
+        profiler.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            session = profiler.stop()
+            sessions.append((getattr(func, "__qualname__", repr(func)), session))
+
+    return profiled
+
+
+class ProfilingMiddleware:
+    """Middleware ASGI que perfila los requests seleccionados."""
+
+    def __init__(self, app):
+        # Import aquí: pyinstrument solo es necesario si el profiling está activado
+        from pyinstrument import Profiler
+
+        self.app = app
+        self._profiler_class = Profiler
+        self.token = settings.PROFILING_TOKEN
+        self.sample_rate = settings.PROFILING_SAMPLE_RATE
+        self.output_dir = Path(settings.PROFILING_DIR)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        requested = self._is_requested(scope)
+        if not requested and not self._is_sampled():
+            await self.app(scope, receive, send)
+            return
+
+        file_name = self._file_name(scope)
+
+        async def send_with_header(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((PROFILE_FILE_HEADER, file_name.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        # El nombre del archivo solo se revela a quien pidió el profile con el token
+        profiled_send = send_with_header if requested else send
+
+        worker_sessions: List[Tuple[str, Any]] = []
+        context_token = _worker_sessions.set(worker_sessions)
+        profiler = self._profiler_class(interval=settings.PROFILING_INTERVAL, async_mode="enabled")
+        profiler.start()
+        try:
+            await self.app(scope, receive, profiled_send)
+        finally:
+            session = profiler.stop()
+            _worker_sessions.reset(context_token)
+            # Renderizar y escribir fuera del event loop
+            await asyncio.to_thread(
+                self._write_profile, file_name, scope["path"], session, worker_sessions
+            )
+
+    def _is_requested(self, scope) -> bool:
+        """Indica si el request trae el token de profiling en el header X-Profile."""
+        if not self.token:
+            return False
+        for name, value in scope.get("headers", []):
+            if name == PROFILE_HEADER:
+                return secrets.compare_digest(value, self.token.encode("utf-8"))
+        return False
+
+    def _is_sampled(self) -> bool:
+        """Decide al azar si perfilar el request (muestreo)."""
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    @staticmethod
+    def _file_name(scope) -> str:
+        """Nombre del archivo de salida: timestamp, método y ruta."""
+        timestamp = time.strftime("%Y%m%dT%H%M%S")
+        path = scope["path"].strip("/").replace("/", "_") or "root"
+        return f"{timestamp}-{secrets.token_hex(3)}-{scope['method']}-{path}.speedscope.json"
+
+    def _write_profile(
+        self,
+        file_name: str,
+        request_path: str,
+        session: Any,
+        worker_sessions: List[Tuple[str, Any]],
+    ) -> None:
+        """Combina el profile del handler y los de los workers en un solo JSON de speedscope."""
+        from pyinstrument.renderers import SpeedscopeRenderer
+
+        renderer = SpeedscopeRenderer()
+        document = json.loads(renderer.render(session))
+        document["name"] = f"{request_path} ({file_name})"
+        document["profiles"][0]["name"] = f"handler {request_path}"
+
+        frames = document["shared"]["frames"]
+        for name, worker_session in worker_sessions:
+            worker_document = json.loads(renderer.render(worker_session))
+            frame_offset = len(frames)
+            frames.extend(worker_document["shared"]["frames"])
+            # Alinear en el tiempo con el handler
+            time_offset = worker_session.start_time - session.start_time
+            for profile in worker_document["profiles"]:
+                profile["name"] = f"worker {name}"
+                profile["startValue"] += time_offset
+                profile["endValue"] += time_offset
+                for event in profile["events"]:
+                    event["frame"] += frame_offset
+                    event["at"] += time_offset
+                document["profiles"].append(profile)
+
+        output_path = self.output_dir / file_name
+        output_path.write_text(json.dumps(document))
+        print(f"Profile guardado en {output_path}")
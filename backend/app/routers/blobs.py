@@ -0,0 +1,72 @@
+"""
+Endpoints para servir stickers ya generados desde el almacén local.
+"""
+import os
+from pathlib import Path
+from typing import Optional, Tuple
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response
+
+from app.services.blob_store import blob_store
+
+router = APIRouter(prefix="/stickers", tags=["stickers"])
+
+# El contenido de un hash nunca cambia: se puede cachear para siempre
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+@router.get("/{sticker_hash}.webp", name="get_sticker")
+async def get_sticker(sticker_hash: str, request: Request):
+    """
+    Devuelve un sticker generado por su hash SHA-256.
+
+    Soporta If-None-Match (304) y peticiones Range.
+    """
+    # Búsqueda y stat tocan disco: fuera del event loop
+    found = await run_in_threadpool(_stat_sticker, sticker_hash)
+    if found is None:
+        raise HTTPException(status_code=404, detail="Sticker no encontrado")
+    path, stat_result = found
+
+    # ETag fuerte: el hash del contenido
+    etag = f'"{sticker_hash}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": CACHE_CONTROL,
+    }
+
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    # FileResponse usa sendfile cuando el servidor lo soporta y atiende Range/If-Range
+    # Con el stat ya hecho no vuelve a consultar el disco antes de responder
+    return FileResponse(path, media_type="image/webp", headers=headers, stat_result=stat_result)
+
+
+def _stat_sticker(sticker_hash: str) -> Optional[Tuple[Path, os.stat_result]]:
+    """
+    Busca el sticker y obtiene su stat.
+
+    get_path lo marca como usado bajo el lock del almacén y el GC respeta los blobs
+    usados hace menos de grace_seconds, así que el archivo sigue en disco cuando
+    FileResponse lo abre. Si aun así falta (p. ej. borrado a mano), es un 404.
+    """
+    path = blob_store.get_path(sticker_hash)
+    if path is None:
+        return None
+    try:
+        return path, path.stat()
+    except FileNotFoundError:
+        return None
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Comprueba If-None-Match (comparación débil, como exige RFC 9110 para GET)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
@@ -1,14 +1,22 @@
 """
 Endpoints para generación de stickers y memes.
 """
+import asyncio
 import base64
-from typing import Optional
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form
+import json
+from typing import AsyncIterator, Optional, Tuple
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, HttpUrl
 import httpx
 
+from app.config import settings
+from app.deadline import check_deadline, stage_timeout
 from app.services.ai_generator import AIGeneratorService
+from app.services.blob_store import blob_store
+from app.services.fal_queue import FalProgress, ProgressCallback
 from app.services.image_processor import StickerProcessor
+from app.services.image_pool import run_in_image_pool
 
 router = APIRouter(prefix="/generate", tags=["stickers"])
 
@@ -27,7 +35,8 @@ class MemeRequest(BaseModel):
 class MemeResponse(BaseModel):
     """Response con sticker generado."""
     success: bool
-    image_base64: str
+    image_base64: Optional[str] = None  # Se omite si se pidió return_url
+    image_url: Optional[str] = None  # URL estable en /stickers/{hash}.webp
     message: str = "Sticker generado exitosamente"
 
 
@@ -39,7 +48,8 @@ class StickerOnlyRequest(BaseModel):
 class StickerOnlyResponse(BaseModel):
     """Response con sticker procesado."""
     success: bool
-    image_base64: str
+    image_base64: Optional[str] = None  # Se omite si se pidió return_url
+    image_url: Optional[str] = None  # URL estable en /stickers/{hash}.webp
     message: str = "Sticker procesado exitosamente"
 
 
@@ -56,9 +66,12 @@ class TextResponse(BaseModel):
 
 @router.post("/meme", response_model=MemeResponse)
 async def generate_meme(
+    request: Request,
     prompt: str = Form(...),
     image_url: Optional[str] = Form(None),
-    image_file: Optional[UploadFile] = File(None)
+    image_file: Optional[UploadFile] = File(None),
+    caption: Optional[str] = Form(None, max_length=settings.CAPTION_MAX_LENGTH),
+    return_url: bool = Form(False)
 ):
     """
     Genera un meme usando IA (Fal.ai) con preservación de identidad facial.
@@ -67,6 +80,8 @@ async def generate_meme(
     - prompt: Descripción del meme
     - image_url: URL de la imagen del usuario (opcional)
     - image_file: Archivo de imagen subido (opcional)
+    - caption: Texto a dibujar sobre el sticker estilo meme (opcional, hasta CAPTION_MAX_LENGTH caracteres)
+    - return_url: Si es true, devuelve solo image_url sin los bytes en base64
     
     Al menos uno de image_url o image_file debe ser proporcionado.
     """
@@ -81,22 +96,9 @@ async def generate_meme(
         # Obtener bytes de la imagen
         image_bytes = await _get_image_bytes(image_url, image_file)
         
-        # Generar imagen con IA
-        generated_image_bytes = await ai_service.generate_meme_image(
-            prompt=prompt,
-            image_bytes=image_bytes
-        )
-        
-        # Procesar imagen para crear sticker
-        sticker_bytes = sticker_processor.create_sticker(generated_image_bytes)
-        
-        # Convertir a base64 para respuesta
-        image_base64 = base64.b64encode(sticker_bytes).decode("utf-8")
-        
-        return MemeResponse(
-            success=True,
-            image_base64=image_base64,
-            message="Meme generado exitosamente"
+        # Sin cliente que escuche el progreso: queda en el log del servidor
+        return await _create_meme(
+            request, prompt, image_bytes, caption, return_url, on_progress=_log_fal_progress
         )
         
     except HTTPException:
@@ -108,10 +110,51 @@ async def generate_meme(
         )
 
 
+@router.post("/meme/stream")
+async def generate_meme_stream(
+    request: Request,
+    prompt: str = Form(...),
+    image_url: Optional[str] = Form(None),
+    image_file: Optional[UploadFile] = File(None),
+    caption: Optional[str] = Form(None, max_length=settings.CAPTION_MAX_LENGTH),
+    return_url: bool = Form(False)
+):
+    """
+    Versión de /generate/meme que informa del progreso de Fal con Server-Sent Events.
+    
+    Acepta los mismos campos que /generate/meme. La imagen se lee y valida antes de
+    abrir el stream, así que los errores de entrada siguen siendo respuestas 400.
+    
+    Eventos:
+    - progress: {"endpoint", "status", "queue_position", "logs"} en cada cambio de estado
+    - done: el mismo JSON que devuelve /generate/meme
+    - error: {"detail": "..."} si la generación falla
+    """
+    if not image_url and not image_file:
+        raise HTTPException(
+            status_code=400,
+            detail="Debes proporcionar image_url o image_file"
+        )
+    
+    image_bytes = await _get_image_bytes(image_url, image_file)
+    
+    return StreamingResponse(
+        _meme_events(request, prompt, image_bytes, caption, return_url),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # Evita que nginx acumule los eventos
+        },
+    )
+
+
 @router.post("/sticker-only", response_model=StickerOnlyResponse)
 async def generate_sticker_only(
+    request: Request,
     image_url: Optional[str] = Form(None),
-    image_file: Optional[UploadFile] = File(None)
+    image_file: Optional[UploadFile] = File(None),
+    caption: Optional[str] = Form(None, max_length=settings.CAPTION_MAX_LENGTH),
+    return_url: bool = Form(False)
 ):
     """
     Procesa una imagen para crear un sticker (quita fondo, añade borde blanco).
@@ -119,6 +162,8 @@ async def generate_sticker_only(
     Acepta:
     - image_url: URL de la imagen (opcional)
     - image_file: Archivo de imagen subido (opcional)
+    - caption: Texto a dibujar sobre el sticker estilo meme (opcional, hasta CAPTION_MAX_LENGTH caracteres)
+    - return_url: Si es true, devuelve solo image_url sin los bytes en base64
     
     Al menos uno de image_url o image_file debe ser proporcionado.
     """
@@ -134,14 +179,17 @@ async def generate_sticker_only(
         image_bytes = await _get_image_bytes(image_url, image_file)
         
         # Procesar imagen para crear sticker
-        sticker_bytes = sticker_processor.create_sticker(image_bytes)
+        sticker_bytes = await run_in_image_pool(
+            sticker_processor.create_sticker, image_bytes, caption
+        )
         
-        # Convertir a base64 para respuesta
-        image_base64 = base64.b64encode(sticker_bytes).decode("utf-8")
+        # Guardar en el almacén local para poder volver a servirlo por URL
+        sticker_url, image_base64 = await _store_sticker(request, sticker_bytes, return_url)
         
         return StickerOnlyResponse(
             success=True,
             image_base64=image_base64,
+            image_url=sticker_url,
             message="Sticker procesado exitosamente"
         )
         
@@ -177,6 +225,174 @@ async def generate_text(request: TextRequest):
         )
 
 
+@router.post("/text/stream")
+async def generate_text_stream(request: TextRequest):
+    """
+    Versión en streaming de /generate/text con Server-Sent Events.
+    
+    Acepta:
+    - context: Contexto o tema para generar el texto
+    
+    Eventos:
+    - token: {"text": "..."} con cada trozo nuevo de la frase
+    - done: {"text": "..."} con la frase completa
+    - error: {"detail": "..."} si la generación falla
+    """
+    return StreamingResponse(
+        _text_events(request.context),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # Evita que nginx acumule los eventos
+        },
+    )
+
+
+async def _text_events(context: str) -> AsyncIterator[str]:
+    """Convierte el stream de texto del servicio en eventos SSE."""
+    text = ""
+    try:
+        async for piece in ai_service.stream_magic_text(context):
+            text += piece
+            yield _sse_event("token", {"text": piece})
+        yield _sse_event("done", {"text": text})
+    except HTTPException as e:
+        yield _sse_event("error", {"detail": e.detail})
+    except Exception as e:
+        yield _sse_event("error", {"detail": f"Error generando texto: {str(e)}"})
+
+
+def _sse_event(event: str, data: dict) -> str:
+    """Formatea un evento SSE con datos JSON (conserva espacios y saltos de línea)."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _meme_events(
+    request: Request,
+    prompt: str,
+    image_bytes: bytes,
+    caption: Optional[str],
+    return_url: bool
+) -> AsyncIterator[str]:
+    """Genera el meme en segundo plano y emite su progreso como eventos SSE."""
+    progress_queue: "asyncio.Queue[FalProgress]" = asyncio.Queue()
+    task = asyncio.create_task(
+        _create_meme(
+            request, prompt, image_bytes, caption, return_url,
+            on_progress=progress_queue.put_nowait
+        )
+    )
+    try:
+        while not task.done():
+            next_progress = asyncio.ensure_future(progress_queue.get())
+            await asyncio.wait({task, next_progress}, return_when=asyncio.FIRST_COMPLETED)
+            if not next_progress.done():
+                next_progress.cancel()
+                break
+            yield _progress_event(next_progress.result())
+        
+        # Progreso que llegó justo antes de terminar
+        while not progress_queue.empty():
+            yield _progress_event(progress_queue.get_nowait())
+        
+        yield _sse_event("done", task.result().model_dump())
+    except HTTPException as e:
+        yield _sse_event("error", {"detail": e.detail})
+    except Exception as e:
+        yield _sse_event("error", {"detail": f"Error generando meme: {str(e)}"})
+    finally:
+        # Si el cliente se desconecta, el trabajo (y su job en Fal) se cancela
+        if not task.done():
+            task.cancel()
+
+
+def _progress_event(progress: FalProgress) -> str:
+    """Formatea el progreso de un trabajo de Fal como evento SSE."""
+    return _sse_event("progress", {
+        "endpoint": progress.endpoint,
+        "status": progress.status,
+        "queue_position": progress.queue_position,
+        "logs": progress.logs,
+    })
+
+
+def _log_fal_progress(progress: FalProgress) -> None:
+    """Registra la posición en cola y el progreso de un trabajo de Fal."""
+    if progress.status == "queued":
+        print(f"Fal {progress.endpoint} ({progress.request_id}): en cola, posición {progress.queue_position}")
+    else:
+        print(f"Fal {progress.endpoint} ({progress.request_id}): {progress.status}")
+
+
+async def _create_meme(
+    request: Request,
+    prompt: str,
+    image_bytes: bytes,
+    caption: Optional[str],
+    return_url: bool,
+    on_progress: Optional[ProgressCallback] = None
+) -> MemeResponse:
+    """
+    Pipeline común de /meme y /meme/stream: Fal, sticker y almacén.
+    
+    Args:
+        request: Request actual (para construir la URL absoluta)
+        prompt: Descripción del meme
+        image_bytes: Bytes de la imagen del usuario
+        caption: Texto opcional a dibujar sobre el sticker
+        return_url: Si es true, no se devuelven los bytes en base64
+        on_progress: Callback con los cambios de estado de la cola de Fal
+        
+    Returns:
+        Respuesta con el sticker generado
+    """
+    # Generar imagen con IA
+    generated_image_bytes = await ai_service.generate_meme_image(
+        prompt=prompt,
+        image_bytes=image_bytes,
+        on_progress=on_progress
+    )
+    
+    # Procesar imagen para crear sticker
+    sticker_bytes = await run_in_image_pool(
+        sticker_processor.create_sticker, generated_image_bytes, caption
+    )
+    
+    # Guardar en el almacén local para poder volver a servirlo por URL
+    sticker_url, image_base64 = await _store_sticker(request, sticker_bytes, return_url)
+    
+    return MemeResponse(
+        success=True,
+        image_base64=image_base64,
+        image_url=sticker_url,
+        message="Meme generado exitosamente"
+    )
+
+
+async def _store_sticker(
+    request: Request,
+    sticker_bytes: bytes,
+    return_url: bool
+) -> Tuple[str, Optional[str]]:
+    """
+    Guarda el sticker en el almacén local y prepara los campos de la respuesta.
+    
+    Args:
+        request: Request actual (para construir la URL absoluta)
+        sticker_bytes: Bytes WEBP del sticker
+        return_url: Si es true, no se devuelven los bytes en base64
+        
+    Returns:
+        Tupla (URL del sticker, base64 o None)
+    """
+    sticker_hash = await run_in_image_pool(blob_store.put, sticker_bytes)
+    image_url = str(request.url_for("get_sticker", sticker_hash=sticker_hash))
+    
+    if return_url:
+        return image_url, None
+    return image_url, base64.b64encode(sticker_bytes).decode("utf-8")
+
+
 # Función auxiliar para obtener bytes de imagen
 async def _get_image_bytes(
     image_url: Optional[str],
@@ -197,13 +413,16 @@ async def _get_image_bytes(
         return await image_file.read()
     
     elif image_url:
-        # Descargar imagen desde URL
+        # Descargar imagen desde URL (timeout limitado por el deadline del request)
+        timeout = stage_timeout(30.0)
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
+            async with httpx.AsyncClient(timeout=timeout) as client:
                 response = await client.get(image_url)
                 response.raise_for_status()
                 return response.content
         except Exception as e:
+            # Si el timeout lo cortó el deadline del request, es un 504 y no un error del cliente
+            check_deadline()
             raise HTTPException(
                 status_code=400,
                 detail=f"Error descargando imagen desde URL: {str(e)}"
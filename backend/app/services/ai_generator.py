@@ -2,13 +2,34 @@
 Servicio de generación de IA para memes y textos.
 """
 import os
+import re
 import httpx
-import fal_client
-from typing import Optional
+from typing import AsyncIterator, List, Optional
 from fastapi import HTTPException
 from openai import AsyncOpenAI
 
 from app.config import settings
+from app.deadline import check_deadline, stage_timeout
+from app.services.face_preprocessor import FacePreprocessor
+from app.services.fal_queue import FalQueueClient, ProgressCallback, build_arguments
+from app.services.image_pool import run_in_image_pool
+
+
+# Prefijos que los modelos a veces anteponen a la frase
+TEXT_PREFIXES = ("Frase:", "Texto:", "Asistente:")
+MAX_TEXT_WORDS = 10
+
+# Extensión del archivo subido a Fal según el MIME type (el preprocesado puede
+# devolver la imagen original si Pillow no la decodifica, p. ej. HEIC)
+UPLOAD_EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/gif": "gif",
+    "image/webp": "webp",
+    "image/heic": "heic",
+    "image/heif": "heif",
+    "image/avif": "avif",
+}
 
 
 class AIGeneratorService:
@@ -19,17 +40,29 @@ class AIGeneratorService:
         # Configurar FAL_KEY en el entorno para fal_client
         os.environ["FAL_KEY"] = self.fal_key
         
+        # Recorte de cara y reducción local antes de subir a Fal
+        self.face_preprocessor = FacePreprocessor()
+        
+        # Cliente asíncrono de la cola de Fal
+        self.fal_queue = FalQueueClient(key=self.fal_key)
+        
         self.openai_client = None
         if settings.OPENAI_API_KEY:
             self.openai_client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
     
-    async def generate_meme_image(self, prompt: str, image_bytes: bytes) -> bytes:
+    async def generate_meme_image(
+        self,
+        prompt: str,
+        image_bytes: bytes,
+        on_progress: Optional[ProgressCallback] = None
+    ) -> bytes:
         """
         Genera una imagen de meme usando Fal.ai con preservación de identidad facial.
         
         Args:
             prompt: Descripción del meme a generar
             image_bytes: Bytes de la imagen del usuario para preservar identidad
+            on_progress: Callback opcional con la posición en cola y el progreso de Fal
             
         Returns:
             Bytes de la imagen generada
@@ -39,8 +72,11 @@ class AIGeneratorService:
         """
         try:
             # CRÍTICO: Subir imagen a la nube temporal de Fal (Fal.ai NO puede leer archivos locales)
-            # fal_client.upload() sube los bytes y devuelve una URL pública
-            uploaded_url = await self._upload_to_fal(image_bytes)
+            # Antes de subir, recortar la cara y reducir a ~1024px (menos bytes y menos inferencia)
+            prepared_bytes, content_type = await run_in_image_pool(
+                self.face_preprocessor.prepare, image_bytes
+            )
+            uploaded_url = await self._upload_to_fal(prepared_bytes, content_type)
             
             # Intentar primero con Flux Schnell (rápido y barato)
             endpoints_to_try = [
@@ -52,42 +88,13 @@ class AIGeneratorService:
             last_error = None
             for endpoint in endpoints_to_try:
                 try:
-                    # Intentar diferentes métodos de fal_client según la versión de la librería
-                    # fal_client puede tener run(), submit(), o subscribe()
-                    try:
-                        # Método 1: run() (más común)
-                        result = await fal_client.run(
-                            endpoint,
-                            arguments={
-                                "prompt": prompt,
-                                "image_url": uploaded_url,  # URL pública de Fal
-                                "num_inference_steps": 30,
-                                "guidance_scale": 7.5,
-                            }
-                        )
-                    except AttributeError:
-                        # Método 2: submit() si run() no existe
-                        try:
-                            result = await fal_client.submit(
-                                endpoint,
-                                arguments={
-                                    "prompt": prompt,
-                                    "image_url": uploaded_url,
-                                    "num_inference_steps": 30,
-                                    "guidance_scale": 7.5,
-                                }
-                            )
-                        except AttributeError:
-                            # Método 3: subscribe() si submit() tampoco existe
-                            result = await fal_client.subscribe(
-                                endpoint,
-                                arguments={
-                                    "prompt": prompt,
-                                    "image_url": uploaded_url,
-                                    "num_inference_steps": 30,
-                                    "guidance_scale": 7.5,
-                                }
-                            )
+                    # Cola de Fal: submit + seguimiento de estado; se cancela si se abandona
+                    result = await self.fal_queue.run(
+                        endpoint,
+                        arguments=build_arguments(endpoint, prompt, uploaded_url),
+                        on_progress=on_progress,
+                        timeout=stage_timeout(settings.FAL_ENDPOINT_TIMEOUT),
+                    )
                     
                     # Obtener la URL de la imagen generada
                     # El formato puede variar según el endpoint
@@ -107,11 +114,14 @@ class AIGeneratorService:
                         raise ValueError(f"No se obtuvo URL de imagen del resultado: {result}")
                     
                     # Descargar la imagen generada
-                    async with httpx.AsyncClient(timeout=30.0) as client:
+                    async with httpx.AsyncClient(timeout=stage_timeout(30.0)) as client:
                         response = await client.get(image_url)
                         response.raise_for_status()
                         return response.content
                         
+                except HTTPException:
+                    # Deadline vencido o request cancelado: no probar más endpoints
+                    raise
                 except Exception as e:
                     last_error = e
                     print(f"Error con endpoint {endpoint}: {e}")
@@ -131,25 +141,29 @@ class AIGeneratorService:
                 detail=f"Error inesperado generando imagen: {str(e)}"
             )
     
-    async def _upload_to_fal(self, image_bytes: bytes) -> str:
+    async def _upload_to_fal(self, image_bytes: bytes, content_type: str = "image/jpeg") -> str:
         """
         Sube una imagen a la nube temporal de Fal y devuelve la URL pública.
         
         Args:
             image_bytes: Bytes de la imagen a subir
+            content_type: MIME type real de la imagen
             
         Returns:
             URL pública de la imagen en Fal
         """
+        # Timeout limitado por lo que le queda al request
+        timeout = stage_timeout(30.0)
         try:
             # Usar la API REST de Fal para subir el archivo
             # Fal tiene un endpoint específico para uploads
-            async with httpx.AsyncClient(timeout=30.0) as client:
+            async with httpx.AsyncClient(timeout=timeout) as client:
                 headers = {
                     "Authorization": f"Key {self.fal_key}",
                 }
+                extension = UPLOAD_EXTENSIONS.get(content_type, "bin")
                 files = {
-                    "file": ("image.jpg", image_bytes, "image/jpeg")
+                    "file": (f"image.{extension}", image_bytes, content_type)
                 }
                 response = await client.post(
                     "https://fal.run/fal-ai/file-upload",
@@ -166,6 +180,8 @@ class AIGeneratorService:
                 return url
                 
         except Exception as upload_error:
+            # Si el timeout lo cortó el deadline del request, es un 504 y no un fallo del upload
+            check_deadline()
             raise HTTPException(
                 status_code=500,
                 detail=f"Error subiendo imagen a Fal: {str(upload_error)}"
@@ -186,16 +202,7 @@ class AIGeneratorService:
             try:
                 response = await self.openai_client.chat.completions.create(
                     model="gpt-4o-mini",
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": "Eres un generador de textos para stickers virales. Genera una frase corta, sarcástica y divertida basada en el contexto del usuario. Máximo 10 palabras."
-                        },
-                        {
-                            "role": "user",
-                            "content": f"Contexto: {context}"
-                        }
-                    ],
+                    messages=self._openai_messages(context),
                     max_tokens=30,
                     temperature=0.9,
                 )
@@ -212,6 +219,81 @@ class AIGeneratorService:
         # Fallback: Usar Hugging Face (código existente)
         return await self._generate_text_hf_fallback(context)
     
+    async def stream_magic_text(self, context: str) -> AsyncIterator[str]:
+        """
+        Igual que generate_magic_text, pero devuelve el texto a trozos según llega.
+        
+        Usa OpenAI con stream=True y aplica la limpieza de prefijos y el límite de
+        palabras de forma incremental. Si el stream falla antes del primer token,
+        se usa la misma cadena de fallback (Hugging Face / frases fijas) como un solo trozo.
+        
+        Args:
+            context: Contexto o tema para generar el texto
+            
+        Yields:
+            Trozos de texto ya limpios; concatenados forman la frase final
+        """
+        if self.openai_client:
+            cleaner = _StreamingTextCleaner()
+            emitted = False
+            stream = None
+            try:
+                stream = await self.openai_client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=self._openai_messages(context),
+                    max_tokens=30,
+                    temperature=0.9,
+                    stream=True,
+                    timeout=stage_timeout(30.0),
+                )
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if not delta:
+                        continue
+                    piece = cleaner.feed(delta)
+                    if piece:
+                        emitted = True
+                        yield piece
+                    if cleaner.done:
+                        break
+                
+                piece = cleaner.flush()
+                if piece:
+                    emitted = True
+                    yield piece
+                if emitted:
+                    return
+                    
+            except HTTPException:
+                raise
+            except Exception as e:
+                if emitted:
+                    # Ya se mandó texto al cliente: no se puede cambiar de proveedor
+                    print(f"Error con el stream de OpenAI a mitad de respuesta: {e}")
+                    return
+                print(f"Error con OpenAI (stream), usando fallback: {e}")
+            finally:
+                if stream is not None:
+                    await stream.close()
+        
+        # Fallback: Hugging Face (sin streaming), enviado como un único trozo
+        yield await self._generate_text_hf_fallback(context)
+    
+    def _openai_messages(self, context: str) -> List[dict]:
+        """Mensajes para OpenAI (compartidos por la versión normal y la de streaming)."""
+        return [
+            {
+                "role": "system",
+                "content": "Eres un generador de textos para stickers virales. Genera una frase corta, sarcástica y divertida basada en el contexto del usuario. Máximo 10 palabras."
+            },
+            {
+                "role": "user",
+                "content": f"Contexto: {context}"
+            }
+        ]
+    
     async def _generate_text_hf_fallback(self, context: str) -> str:
         """
         Genera texto usando Hugging Face como fallback.
@@ -290,10 +372,69 @@ class AIGeneratorService:
     
     def _clean_text(self, text: str) -> str:
         """Limpia el texto generado eliminando prefijos comunes."""
-        text = text.replace("Frase:", "").replace("Texto:", "").replace("Asistente:", "").strip()
+        for prefix in TEXT_PREFIXES:
+            text = text.replace(prefix, "")
+        text = text.strip()
         # Limitar a 10 palabras
         words = text.split()
-        if len(words) > 10:
-            text = " ".join(words[:10])
+        if len(words) > MAX_TEXT_WORDS:
+            text = " ".join(words[:MAX_TEXT_WORDS])
         return text
 
+
+class _StreamingTextCleaner:
+    """
+    Versión incremental de AIGeneratorService._clean_text para texto en streaming.
+    
+    Retiene el final del buffer mientras pueda ser el comienzo de un prefijo
+    ("Fra" puede acabar siendo "Frase:") y corta al llegar a MAX_TEXT_WORDS palabras.
+    """
+    
+    def __init__(self):
+        self._raw = ""
+        self._emitted = ""
+        self.done = False
+    
+    def feed(self, delta: str) -> str:
+        """Añade un trozo del modelo y devuelve el texto nuevo que ya es seguro enviar."""
+        self._raw += delta
+        return self._emit(self._raw[:len(self._raw) - self._held_back()])
+    
+    def flush(self) -> str:
+        """Devuelve lo que quedaba retenido al terminar el stream."""
+        return self._emit(self._raw)
+    
+    def _held_back(self) -> int:
+        """Longitud del final del buffer que podría ser el inicio de un prefijo."""
+        longest = 0
+        for prefix in TEXT_PREFIXES:
+            for size in range(1, len(prefix)):
+                if size > longest and self._raw.endswith(prefix[:size]):
+                    longest = size
+        return longest
+    
+    def _emit(self, raw: str) -> str:
+        """Limpia el texto acumulado y devuelve solo la parte aún no enviada."""
+        if self.done:
+            return ""
+        
+        text = raw
+        for prefix in TEXT_PREFIXES:
+            text = text.replace(prefix, "")
+        text = text.lstrip()
+        
+        words = list(re.finditer(r"\S+", text))
+        if len(words) > MAX_TEXT_WORDS:
+            # Ya empezó la palabra 11: la 10 está completa
+            text = text[:words[MAX_TEXT_WORDS - 1].end()]
+            self.done = True
+        else:
+            # Los espacios finales se envían junto con la palabra siguiente
+            text = text.rstrip()
+        
+        if not text.startswith(self._emitted):
+            return ""
+        piece = text[len(self._emitted):]
+        self._emitted = text
+        return piece
+
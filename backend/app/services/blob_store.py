@@ -0,0 +1,175 @@
+"""
+Almacén local direccionado por contenido para los stickers generados.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from app.config import settings
+
+
+_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# Las rutas relativas se resuelven contra backend/, no contra el directorio de trabajo
+_BACKEND_DIR = Path(__file__).resolve().parents[2]
+
+
+class BlobStore:
+    """
+    Guarda stickers en disco con su SHA-256 como nombre, con recolección LRU por tamaño.
+
+    El mtime de cada archivo hace de marca de último uso: se actualiza al guardar o servir
+    un blob, y la recolección borra primero los más antiguos. Los blobs usados hace menos
+    de grace_seconds no se borran, para no quitarle el archivo a una respuesta en curso.
+
+    No toca el disco al crearse: la carpeta se crea con el primer blob y el tamaño total
+    se calcula la primera vez que hace falta.
+    """
+
+    def __init__(
+        self,
+        root: str = settings.BLOB_STORE_DIR,
+        max_bytes: int = settings.BLOB_STORE_MAX_BYTES,
+        extension: str = ".webp",
+        grace_seconds: float = 60.0,
+    ):
+        self.root = _BACKEND_DIR / root
+        self.max_bytes = max_bytes
+        self.extension = extension
+        self.grace_seconds = grace_seconds
+
+        self._lock = threading.Lock()
+        self._total_bytes: Optional[int] = None
+
+    def put(self, data: bytes) -> str:
+        """
+        Guarda los bytes (si no existían) y devuelve su hash.
+
+        Args:
+            data: Contenido del blob
+
+        Returns:
+            SHA-256 hexadecimal del contenido
+        """
+        blob_hash = hashlib.sha256(data).hexdigest()
+        path = self._path(blob_hash)
+
+        with self._lock:
+            if path.exists():
+                self._touch(path)
+                return blob_hash
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Escritura atómica: nunca se sirve un archivo a medio escribir
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(data)
+            with self._lock:
+                # Otro worker pudo guardar el mismo contenido mientras se escribía
+                created = not path.exists()
+                os.replace(tmp_path, path)
+                if self._total_bytes is None:
+                    self._total_bytes = self._scan_total_bytes()
+                elif created:
+                    self._total_bytes += len(data)
+                over_limit = self._total_bytes > self.max_bytes
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        if over_limit:
+            self.collect_garbage()
+
+        return blob_hash
+
+    def get_path(self, blob_hash: str) -> Optional[Path]:
+        """
+        Devuelve la ruta del blob si existe (y lo marca como usado).
+
+        Args:
+            blob_hash: SHA-256 hexadecimal
+
+        Returns:
+            Ruta del archivo o None si el hash no es válido o no existe
+
+        Búsqueda y marca van bajo el mismo lock que la recolección: si devuelve una
+        ruta, el archivo no se borra durante los siguientes grace_seconds.
+        """
+        if not _HASH_PATTERN.match(blob_hash):
+            return None
+        path = self._path(blob_hash)
+        with self._lock:
+            if not path.is_file():
+                return None
+            self._touch(path)
+        return path
+
+    def collect_garbage(self, target_ratio: float = 0.9) -> int:
+        """
+        Borra los blobs menos usados hasta quedar por debajo de max_bytes * target_ratio.
+
+        Returns:
+            Número de bytes liberados
+        """
+        with self._lock:
+            entries = []
+            for path in self._iter_blobs():
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            target = int(self.max_bytes * target_ratio)
+            in_use_since = time.time() - self.grace_seconds
+            freed = 0
+            for mtime, size, path in sorted(entries, key=lambda entry: entry[0]):
+                # Ordenados por mtime: a partir de aquí todos se usaron hace poco
+                if total - freed <= target or mtime > in_use_since:
+                    break
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+                freed += size
+
+            self._total_bytes = total - freed
+            return freed
+
+    def _path(self, blob_hash: str) -> Path:
+        """Ruta del blob, repartida en subcarpetas por los dos primeros caracteres."""
+        return self.root / blob_hash[:2] / f"{blob_hash}{self.extension}"
+
+    def _scan_total_bytes(self) -> int:
+        """Suma el tamaño de los blobs que ya hay en disco."""
+        total = 0
+        for path in self._iter_blobs():
+            try:
+                total += path.stat().st_size
+            except FileNotFoundError:
+                pass
+        return total
+
+    def _iter_blobs(self):
+        """Itera sobre todos los blobs guardados."""
+        return self.root.glob(f"*/*{self.extension}")
+
+    @staticmethod
+    def _touch(path: Path) -> None:
+        """Actualiza el mtime (marca de último uso para el LRU)."""
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+
+# Instancia global del almacén
+blob_store = BlobStore()
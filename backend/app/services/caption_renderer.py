@@ -0,0 +1,348 @@
+"""
+Renderizado de textos estilo meme (blanco con contorno negro) sobre los stickers.
+"""
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from app.config import settings
+
+
+# Fuentes a probar si no se configura CAPTION_FONT_PATH (Pillow las busca en las
+# carpetas de fuentes del sistema)
+FALLBACK_FONTS = (
+    "Impact.ttf",
+    "impact.ttf",
+    "DejaVuSans-Bold.ttf",
+    "LiberationSans-Bold.ttf",
+    "Arial Bold.ttf",
+)
+
+
+@dataclass
+class Glyph:
+    """Glifo pre-rasterizado: máscaras de relleno y contorno listas para pegar."""
+    # Máscaras (h, w) uint8; None para caracteres sin tinta (espacios)
+    fill_mask: Optional[np.ndarray]
+    stroke_mask: Optional[np.ndarray]
+    offset: Tuple[int, int]
+    advance: float
+
+
+@lru_cache(maxsize=32)
+def _get_font(size: int) -> ImageFont.FreeTypeFont:
+    """Carga (una sola vez por tamaño) la fuente de los captions."""
+    candidates = (settings.CAPTION_FONT_PATH,) if settings.CAPTION_FONT_PATH else FALLBACK_FONTS
+    for path in candidates:
+        try:
+            return ImageFont.truetype(path, size)
+        except OSError:
+            continue
+    # Fuente por defecto de Pillow (escalable desde Pillow 10.1)
+    return ImageFont.load_default(size=size)
+
+
+class CaptionRenderer:
+    """
+    Dibuja un caption con auto-ajuste de tamaño y saltos de línea.
+
+    Los glifos se rasterizan una vez por (carácter, tamaño) y se guardan en un atlas
+    LRU acotado; renderizar un caption es solo pegar máscaras ya calculadas en dos
+    máscaras del bloque de texto (contorno y relleno) y componerlas una sola vez sobre
+    el array RGBA del sticker, in-place.
+    """
+
+    # Los tamaños se redondean a múltiplos de este paso para reutilizar el atlas
+    SIZE_STEP = 4
+    MIN_FONT_SIZE = 12
+    # Final de un caption que no cabe ni con el tamaño mínimo
+    ELLIPSIS = "..."
+
+    def __init__(
+        self,
+        atlas_size: int = settings.CAPTION_ATLAS_SIZE,
+        max_height_ratio: float = 0.3,
+        padding_ratio: float = 0.04,
+    ):
+        self.atlas_size = atlas_size
+        self.max_height_ratio = max_height_ratio
+        self.padding_ratio = padding_ratio
+
+        self._atlas: "OrderedDict[Tuple[str, int], Glyph]" = OrderedDict()
+        self._atlas_lock = threading.Lock()
+
+    def render(self, image: np.ndarray, text: str) -> np.ndarray:
+        """
+        Dibuja el caption centrado en la parte inferior de la imagen.
+
+        Args:
+            image: Array RGBA (H, W, 4) uint8 escribible (se modifica in-place)
+            text: Texto del caption
+
+        Returns:
+            El mismo array con el caption dibujado
+        """
+        text = " ".join(text.upper().split())
+        if not text:
+            return image
+
+        height, width = image.shape[:2]
+        padding = max(2, int(min(width, height) * self.padding_ratio))
+        max_width = width - padding * 2
+        max_height = int(height * self.max_height_ratio)
+
+        size, lines = self._fit_text(text, max_width, max_height)
+        font = _get_font(size)
+        stroke_width = self._stroke_width(size)
+        line_height = self._line_height(font, stroke_width)
+
+        # Bloque de texto anclado abajo (con margen arriba para el contorno)
+        block_y = height - padding - line_height * len(lines)
+        block_top = max(0, block_y - stroke_width)
+        stroke_mask = np.zeros((height - block_top, width), dtype=np.uint8)
+        fill_mask = np.zeros_like(stroke_mask)
+
+        y = block_y - block_top
+        for line in lines:
+            line_width = int(self._text_width(line, size)) + stroke_width * 2
+            x = (width - line_width) // 2 + stroke_width
+            self._draw_line(stroke_mask, fill_mask, line, size, x, y)
+            y += line_height
+
+        self._composite(image[block_top:], stroke_mask, fill_mask)
+
+        return image
+
+    def _fit_text(self, text: str, max_width: int, max_height: int) -> Tuple[int, List[str]]:
+        """
+        Busca (bisección) el mayor tamaño de fuente con el que el texto envuelto cabe en la caja.
+
+        Si ni con el tamaño mínimo cabe, se recortan las líneas sobrantes y se termina
+        con puntos suspensivos en lugar de dibujar un bloque que se sale de la imagen.
+        """
+        low = self.MIN_FONT_SIZE // self.SIZE_STEP
+        high = max(low, self._quantize(max_height // 2) // self.SIZE_STEP)
+
+        best_size = low * self.SIZE_STEP
+        fits, best_lines = self._layout(text, best_size, max_width, max_height)
+        if not fits:
+            return best_size, self._truncate(best_lines, best_size, max_width, max_height)
+
+        low += 1
+        while low <= high:
+            middle = (low + high) // 2
+            size = middle * self.SIZE_STEP
+            fits, lines = self._layout(text, size, max_width, max_height)
+            if fits:
+                best_size, best_lines = size, lines
+                low = middle + 1
+            else:
+                high = middle - 1
+        return best_size, best_lines
+
+    def _layout(
+        self, text: str, size: int, max_width: int, max_height: int
+    ) -> Tuple[bool, List[str]]:
+        """Envuelve el texto a un tamaño dado e indica si cabe en la caja."""
+        font = _get_font(size)
+        stroke_width = self._stroke_width(size)
+        max_lines = self._max_lines(font, stroke_width, max_height)
+        lines = self._wrap(text, size, max_width - stroke_width * 2, max_lines)
+        fits_width = all(
+            self._text_width(line, size) + stroke_width * 2 <= max_width for line in lines
+        )
+        return fits_width and len(lines) <= max_lines, lines
+
+    def _wrap(self, text: str, size: int, max_width: int, max_lines: int) -> List[str]:
+        """
+        Parte el texto en líneas que no superen max_width (por palabras).
+
+        Deja de envolver en cuanto pasa de max_lines: devolver max_lines + 1 líneas ya
+        indica que el texto no cabe, sin recorrer el resto.
+        """
+        lines: List[str] = []
+        current = ""
+        for word in text.split():
+            candidate = f"{current} {word}" if current else word
+            if current and self._text_width(candidate, size) > max_width:
+                lines.append(current)
+                if len(lines) > max_lines:
+                    return lines
+                current = word
+            else:
+                current = candidate
+        if current:
+            lines.append(current)
+        return lines
+
+    def _truncate(self, lines: List[str], size: int, max_width: int, max_height: int) -> List[str]:
+        """Deja solo las líneas que caben y acorta con "..." las que se salen."""
+        font = _get_font(size)
+        stroke_width = self._stroke_width(size)
+        max_lines = self._max_lines(font, stroke_width, max_height)
+        line_width = max_width - stroke_width * 2
+
+        truncated = [
+            line if self._text_width(line, size) <= line_width
+            else self._ellipsize(line, size, line_width)
+            for line in lines[:max_lines]
+        ]
+        if len(lines) > max_lines and not truncated[-1].endswith(self.ELLIPSIS):
+            truncated[-1] = self._ellipsize(truncated[-1], size, line_width)
+        return truncated
+
+    def _ellipsize(self, line: str, size: int, max_width: int) -> str:
+        """Corta la línea para que quepa seguida de "..."."""
+        budget = max_width - self._text_width(self.ELLIPSIS, size)
+        width = 0.0
+        cut = 0
+        for char in line:
+            width += self._get_glyph(char, size).advance
+            if width > budget:
+                break
+            cut += 1
+        return line[:cut].rstrip() + self.ELLIPSIS
+
+    def _text_width(self, text: str, size: int) -> float:
+        """
+        Ancho del texto como suma de los avances de sus glifos.
+
+        Sale del atlas (sin llamar a FreeType con el atlas caliente) y coincide con
+        cómo _draw_line avanza el cursor, así que el layout y el dibujo no se desalinean.
+        """
+        return sum(self._get_glyph(char, size).advance for char in text)
+
+    def _draw_line(
+        self, stroke_mask: np.ndarray, fill_mask: np.ndarray, line: str, size: int, x: int, y: int
+    ) -> None:
+        """Estampa los glifos de una línea en las máscaras del bloque."""
+        cursor = float(x)
+        for char in line:
+            glyph = self._get_glyph(char, size)
+            if glyph.fill_mask is not None:
+                position = (int(cursor) + glyph.offset[0], y + glyph.offset[1])
+                self._stamp(stroke_mask, glyph.stroke_mask, *position)
+                self._stamp(fill_mask, glyph.fill_mask, *position)
+            cursor += glyph.advance
+
+    @staticmethod
+    def _stamp(target: np.ndarray, mask: np.ndarray, x: int, y: int) -> None:
+        """Combina (máximo) la máscara de un glifo en la máscara del bloque, recortando bordes."""
+        mask_height, mask_width = mask.shape
+        height, width = target.shape
+
+        left, top = max(x, 0), max(y, 0)
+        right, bottom = min(x + mask_width, width), min(y + mask_height, height)
+        if left >= right or top >= bottom:
+            return
+
+        region = target[top:bottom, left:right]
+        np.maximum(region, mask[top - y:bottom - y, left - x:right - x], out=region)
+
+    @staticmethod
+    def _composite(image: np.ndarray, stroke_mask: np.ndarray, fill_mask: np.ndarray) -> None:
+        """
+        Compone el texto (relleno blanco sobre contorno negro) sobre la imagen RGBA, in-place.
+
+        Usa el operador "over", así que sobre zonas transparentes el texto conserva su
+        color en lugar de mezclarse con el RGB oculto de esos píxeles. Las operaciones
+        son de OpenCV sobre uint8 (saturadas y vectorizadas).
+        """
+        # Solo la ventana donde hay texto
+        rows = np.flatnonzero(stroke_mask.any(axis=1))
+        if rows.size == 0:
+            return
+        cols = np.flatnonzero(stroke_mask.any(axis=0))
+        window = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+        region = image[window]
+        fill = np.ascontiguousarray(fill_mask[window])
+        stroke = np.ascontiguousarray(stroke_mask[window])
+
+        # Alfa del texto (relleno sobre contorno) y lo que deja pasar del destino
+        text_alpha = cv2.add(fill, cv2.multiply(stroke, 255 - fill, scale=1 / 255))
+        dest_alpha = cv2.extractChannel(region, 3)
+        dest_weight = cv2.multiply(dest_alpha, 255 - text_alpha, scale=1 / 255)
+        out_alpha = cv2.add(text_alpha, dest_weight)
+
+        # Color: blanco con peso del relleno + destino con su peso, normalizado por el alfa
+        color = cv2.add(
+            cv2.multiply(region, cv2.merge([dest_weight] * 4), scale=1 / 255),
+            cv2.merge([fill, fill, fill, np.zeros_like(fill)]),
+        )
+        result = cv2.divide(color, cv2.merge([out_alpha] * 4), scale=255)
+        cv2.insertChannel(out_alpha, result, 3)
+
+        # Solo se escriben los píxeles con texto: el redondeo de multiply/divide en
+        # uint8 alteraría el RGB de píxeles semitransparentes sin texto en la ventana
+        cv2.copyTo(result, cv2.max(stroke, fill), region)
+
+    def _get_glyph(self, char: str, size: int) -> Glyph:
+        """Devuelve el glifo del atlas, rasterizándolo si no estaba."""
+        key = (char, size)
+        with self._atlas_lock:
+            glyph = self._atlas.get(key)
+            if glyph is not None:
+                self._atlas.move_to_end(key)
+                return glyph
+
+        glyph = self._rasterize(char, size)
+
+        with self._atlas_lock:
+            self._atlas[key] = glyph
+            self._atlas.move_to_end(key)
+            while len(self._atlas) > self.atlas_size:
+                self._atlas.popitem(last=False)
+        return glyph
+
+    def _rasterize(self, char: str, size: int) -> Glyph:
+        """Rasteriza las máscaras de relleno y contorno de un carácter."""
+        font = _get_font(size)
+        stroke_width = self._stroke_width(size)
+        advance = font.getlength(char)
+
+        left, top, right, bottom = font.getbbox(char, stroke_width=stroke_width)
+        if right <= left or bottom <= top:
+            # Espacios y caracteres sin tinta: solo avanzan el cursor
+            return Glyph(fill_mask=None, stroke_mask=None, offset=(0, 0), advance=advance)
+
+        mask_size = (right - left, bottom - top)
+        origin = (-left, -top)
+
+        stroke_mask = Image.new("L", mask_size, 0)
+        ImageDraw.Draw(stroke_mask).text(
+            origin, char, font=font, fill=255, stroke_width=stroke_width, stroke_fill=255
+        )
+        fill_mask = Image.new("L", mask_size, 0)
+        ImageDraw.Draw(fill_mask).text(origin, char, font=font, fill=255)
+
+        return Glyph(
+            fill_mask=np.asarray(fill_mask),
+            stroke_mask=np.asarray(stroke_mask),
+            offset=(left, top),
+            advance=advance,
+        )
+
+    def _quantize(self, size: int) -> int:
+        """Redondea el tamaño hacia abajo al paso del atlas."""
+        return max(self.MIN_FONT_SIZE, size - size % self.SIZE_STEP)
+
+    @staticmethod
+    def _stroke_width(size: int) -> int:
+        """Grosor del contorno proporcional al tamaño de fuente."""
+        return max(1, size // 12)
+
+    def _max_lines(self, font: ImageFont.FreeTypeFont, stroke_width: int, max_height: int) -> int:
+        """Número de líneas que caben en max_height (al menos una)."""
+        return max(1, max_height // self._line_height(font, stroke_width))
+
+    @staticmethod
+    def _line_height(font: ImageFont.FreeTypeFont, stroke_width: int) -> int:
+        """Alto de línea incluyendo el contorno."""
+        ascent, descent = font.getmetrics()
+        return ascent + descent + stroke_width * 2
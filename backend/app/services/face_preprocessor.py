@@ -0,0 +1,212 @@
+"""
+Preprocesamiento local de la foto del usuario antes de subirla a Fal.
+"""
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+from app.config import settings
+
+
+# Firmas de formatos de imagen habituales, para etiquetar los bytes que no se procesan
+_MAGIC_NUMBERS = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+# Marcas de la caja ftyp de HEIF (fotos de iPhone) y AVIF
+_HEIF_BRANDS = {
+    b"heic": "image/heic",
+    b"heix": "image/heic",
+    b"mif1": "image/heif",
+    b"msf1": "image/heif",
+    b"avif": "image/avif",
+}
+
+
+class FacePreprocessor:
+    """
+    Recorta la cara (o el sujeto) de la foto, la reduce y la re-codifica de forma compacta.
+
+    Para preservar la identidad solo importa la región de la cara a ~1024px, así que
+    subir la foto completa (varios MB) solo añade latencia al upload y a la inferencia.
+    Los detectores son los clasificadores Haar que vienen con OpenCV (sin red).
+    """
+
+    # Tamaño máximo del lado mayor de la imagen usada para detectar (más rápido)
+    DETECTION_MAX_SIDE = 640
+
+    def __init__(
+        self,
+        max_side: int = settings.FAL_UPLOAD_MAX_SIDE,
+        cache_size: int = settings.FAL_UPLOAD_CACHE_SIZE,
+        margin: float = 0.8,
+        jpeg_quality: int = 90,
+    ):
+        self.max_side = max_side
+        self.cache_size = cache_size
+        self.margin = margin
+        self.jpeg_quality = jpeg_quality
+
+        # Caché LRU: hash del input -> (bytes procesados, MIME type)
+        self._cache: "OrderedDict[str, Tuple[bytes, str]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+        # CascadeClassifier no es thread-safe: una instancia por worker
+        self._local = threading.local()
+
+    def prepare(self, image_bytes: bytes) -> Tuple[bytes, str]:
+        """
+        Prepara la imagen para subirla a Fal: recorta la cara con margen, reduce y re-codifica.
+
+        Args:
+            image_bytes: Bytes de la imagen original (cualquier formato soportado por Pillow)
+
+        Returns:
+            Tupla (bytes de la imagen preparada, MIME type real)
+
+        Si la imagen no se puede decodificar (p. ej. HEIC sin soporte en Pillow) o
+        falla la detección, se devuelven los bytes originales: este paso es solo una
+        optimización y Fal puede aceptar formatos que Pillow no lee.
+        """
+        key = hashlib.sha256(image_bytes).hexdigest()
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                return cached
+
+        try:
+            result = self._process(image_bytes)
+        except Exception as e:
+            content_type = sniff_mime_type(image_bytes)
+            print(f"No se pudo preprocesar la imagen ({content_type}), se sube tal cual: {e}")
+            result = (image_bytes, content_type)
+
+        with self._cache_lock:
+            self._cache[key] = result
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return result
+
+    def _process(self, image_bytes: bytes) -> Tuple[bytes, str]:
+        """Decodifica, recorta, reduce y re-codifica la imagen."""
+        image = Image.open(io.BytesIO(image_bytes))
+        # Las fotos de móvil suelen venir rotadas vía EXIF
+        image = ImageOps.exif_transpose(image)
+
+        has_alpha = image.mode in ("RGBA", "LA") or (
+            image.mode == "P" and "transparency" in image.info
+        )
+        image = image.convert("RGBA" if has_alpha else "RGB")
+
+        box = self._detect_subject(image)
+        if box is not None:
+            image = image.crop(box)
+
+        # Reducir solo si hace falta (nunca ampliar)
+        if max(image.size) > self.max_side:
+            image.thumbnail((self.max_side, self.max_side), Image.Resampling.LANCZOS)
+
+        output = io.BytesIO()
+        if has_alpha:
+            image.save(output, format="PNG", optimize=True)
+            return output.getvalue(), "image/png"
+
+        image.save(output, format="JPEG", quality=self.jpeg_quality, optimize=True)
+        return output.getvalue(), "image/jpeg"
+
+    def _detect_subject(self, image: Image.Image) -> Optional[Tuple[int, int, int, int]]:
+        """
+        Detecta la cara más grande (o, si no hay, la parte superior del cuerpo).
+
+        Args:
+            image: Imagen PIL en RGB o RGBA
+
+        Returns:
+            Caja (left, top, right, bottom) con margen en coordenadas de la imagen original,
+            o None si no se detectó nada
+        """
+        width, height = image.size
+        scale = min(1.0, self.DETECTION_MAX_SIDE / max(width, height))
+
+        small = image
+        if scale < 1.0:
+            small = image.resize(
+                (max(1, int(width * scale)), max(1, int(height * scale))),
+                Image.Resampling.BILINEAR,
+            )
+        gray = cv2.cvtColor(np.asarray(small.convert("RGB")), cv2.COLOR_RGB2GRAY)
+        gray = cv2.equalizeHist(gray)
+
+        face_cascade, body_cascade = self._get_cascades()
+
+        detections = face_cascade.detectMultiScale(
+            gray, scaleFactor=1.1, minNeighbors=5, minSize=(40, 40)
+        )
+        margin = self.margin
+        if len(detections) == 0:
+            detections = body_cascade.detectMultiScale(
+                gray, scaleFactor=1.1, minNeighbors=3, minSize=(60, 60)
+            )
+            # La caja del torso ya incluye contexto alrededor de la cara
+            margin = self.margin / 4
+        if len(detections) == 0:
+            return None
+
+        # Quedarse con la detección de mayor área
+        x, y, w, h = max(detections, key=lambda d: d[2] * d[3])
+        x, y, w, h = (v / scale for v in (x, y, w, h))
+
+        # Expandir con margen (pelo, mentón y hombros ayudan a preservar identidad)
+        pad_x = w * margin
+        pad_y = h * margin
+        left = max(0, int(x - pad_x))
+        top = max(0, int(y - pad_y))
+        right = min(width, int(x + w + pad_x))
+        bottom = min(height, int(y + h + pad_y * 1.5))
+
+        if right - left < 2 or bottom - top < 2:
+            return None
+        return left, top, right, bottom
+
+    def _get_cascades(self) -> Tuple[cv2.CascadeClassifier, cv2.CascadeClassifier]:
+        """Devuelve los clasificadores del hilo actual, cargándolos la primera vez."""
+        cascades = getattr(self._local, "cascades", None)
+        if cascades is None:
+            base_path = cv2.data.haarcascades
+            cascades = (
+                cv2.CascadeClassifier(base_path + "haarcascade_frontalface_default.xml"),
+                cv2.CascadeClassifier(base_path + "haarcascade_upperbody.xml"),
+            )
+            self._local.cascades = cascades
+        return cascades
+
+
+def sniff_mime_type(data: bytes) -> str:
+    """
+    Deduce el MIME type de una imagen por sus primeros bytes.
+
+    Args:
+        data: Bytes de la imagen
+
+    Returns:
+        MIME type, o "application/octet-stream" si no se reconoce
+    """
+    for magic, mime_type in _MAGIC_NUMBERS:
+        if data.startswith(magic):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:8] == b"ftyp":
+        return _HEIF_BRANDS.get(data[8:12], "application/octet-stream")
+    return "application/octet-stream"
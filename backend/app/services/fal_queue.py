@@ -0,0 +1,178 @@
+"""
+Cliente asíncrono para la API de cola de Fal.ai (submit, estado, resultado y cancelación).
+"""
+import asyncio
+import inspect
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
+
+import fal_client
+
+from app import metrics
+
+
+# Parámetros de inferencia por endpoint: Schnell está destilado para 1-4 pasos
+# y no usa guidance; mandarle 30 pasos solo multiplica la latencia
+ENDPOINT_ARGUMENTS: Dict[str, Dict[str, Any]] = {
+    "fal-ai/flux/schnell": {
+        "num_inference_steps": 4,
+    },
+    "fal-ai/flux/dev": {
+        "num_inference_steps": 28,
+        "guidance_scale": 3.5,
+    },
+    "fal-ai/fast-sdxl": {
+        "num_inference_steps": 25,
+        "guidance_scale": 7.5,
+    },
+}
+
+
+@dataclass
+class FalProgress:
+    """Estado de un trabajo en la cola de Fal."""
+    endpoint: str
+    request_id: str
+    status: str  # "queued", "in_progress" o "completed"
+    queue_position: Optional[int] = None
+    logs: List[str] = field(default_factory=list)
+
+
+ProgressCallback = Callable[[FalProgress], Union[None, Awaitable[None]]]
+
+
+def build_arguments(endpoint: str, prompt: str, image_url: str) -> Dict[str, Any]:
+    """
+    Construye los argumentos de inferencia para un endpoint concreto.
+
+    Args:
+        endpoint: ID del endpoint de Fal
+        prompt: Descripción del meme
+        image_url: URL pública de la imagen del usuario
+
+    Returns:
+        Diccionario de argumentos para el endpoint
+    """
+    arguments: Dict[str, Any] = {
+        "prompt": prompt,
+        "image_url": image_url,
+    }
+    arguments.update(ENDPOINT_ARGUMENTS.get(endpoint, {}))
+    return arguments
+
+
+class FalQueueClient:
+    """Envía trabajos a la cola de Fal, propaga su progreso y los cancela si se abandonan."""
+
+    def __init__(self, key: str, poll_interval: float = 0.25):
+        self._client = fal_client.AsyncClient(key=key)
+        self.poll_interval = poll_interval
+
+    async def run(
+        self,
+        endpoint: str,
+        arguments: Dict[str, Any],
+        on_progress: Optional[ProgressCallback] = None,
+        timeout: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """
+        Ejecuta un trabajo en la cola de Fal y espera su resultado.
+
+        Si la corrutina se cancela (la petición se abandonó) o vence el timeout,
+        el trabajo se cancela también en Fal para no seguir consumiendo GPU.
+
+        Args:
+            endpoint: ID del endpoint de Fal
+            arguments: Argumentos de inferencia
+            on_progress: Callback (sync o async) que recibe cada cambio de estado
+            timeout: Segundos máximos de espera (cola + inferencia)
+
+        Returns:
+            Resultado del endpoint
+        """
+        handle = await self._client.submit(endpoint, arguments=arguments)
+        try:
+            return await asyncio.wait_for(
+                self._wait_for_result(endpoint, handle, on_progress),
+                timeout=timeout,
+            )
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            await self._cancel(handle)
+            raise
+
+    async def _wait_for_result(
+        self,
+        endpoint: str,
+        handle: "fal_client.AsyncRequestHandle",
+        on_progress: Optional[ProgressCallback],
+    ) -> Dict[str, Any]:
+        """
+        Sigue los eventos de estado del trabajo y devuelve el resultado al completarse.
+
+        Fal devuelve un evento por cada consulta (cada poll_interval); el callback solo
+        recibe los cambios de estado o de posición en la cola.
+        """
+        last_state = None
+        # Los logs solo se piden si hay alguien que los vaya a recibir
+        events = handle.iter_events(with_logs=on_progress is not None, interval=self.poll_interval)
+        async for event in events:
+            if on_progress is None:
+                continue
+
+            if isinstance(event, fal_client.Queued):
+                progress = FalProgress(
+                    endpoint=endpoint,
+                    request_id=handle.request_id,
+                    status="queued",
+                    queue_position=event.position,
+                )
+            elif isinstance(event, fal_client.InProgress):
+                progress = FalProgress(
+                    endpoint=endpoint,
+                    request_id=handle.request_id,
+                    status="in_progress",
+                    logs=self._log_messages(event.logs),
+                )
+            elif isinstance(event, fal_client.Completed):
+                progress = FalProgress(
+                    endpoint=endpoint,
+                    request_id=handle.request_id,
+                    status="completed",
+                    logs=self._log_messages(event.logs),
+                )
+            else:
+                continue
+
+            state = (progress.status, progress.queue_position)
+            if state == last_state:
+                continue
+            last_state = state
+
+            await self._notify(on_progress, progress)
+
+        return await handle.get()
+
+    async def _cancel(self, handle: "fal_client.AsyncRequestHandle") -> None:
+        """Cancela el trabajo en Fal; los errores se ignoran (el trabajo pudo haber terminado)."""
+        try:
+            await handle.cancel()
+            metrics.increment("fal_jobs_cancelled")
+        except Exception as e:
+            print(f"No se pudo cancelar el trabajo de Fal {handle.request_id}: {e}")
+
+    @staticmethod
+    async def _notify(on_progress: ProgressCallback, progress: FalProgress) -> None:
+        """Invoca el callback de progreso sin dejar que sus errores rompan la generación."""
+        try:
+            result = on_progress(progress)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            print(f"Error en callback de progreso de Fal: {e}")
+
+    @staticmethod
+    def _log_messages(logs: Optional[List[Dict[str, Any]]]) -> List[str]:
+        """Extrae los mensajes de los logs de Fal."""
+        if not logs:
+            return []
+        return [log.get("message", "") for log in logs if isinstance(log, dict)]
@@ -0,0 +1,62 @@
+"""
+Pool de workers para el trabajo de imagen (CPU-bound) fuera del event loop.
+"""
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable
+
+from app import metrics
+from app.config import settings
+from app.deadline import DeadlineExceeded, remaining_time
+from app.profiling import wrap_for_profiling
+
+
+# rembg (onnxruntime), OpenCV y Pillow liberan el GIL en sus operaciones pesadas,
+# así que un pool de hilos basta y evita serializar arrays entre procesos
+_executor = ThreadPoolExecutor(
+    max_workers=settings.IMAGE_WORKERS,
+    thread_name_prefix="image-worker",
+)
+
+
+async def run_in_image_pool(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """
+    Ejecuta una función de procesamiento de imagen en el pool de workers.
+
+    El trabajo hereda el contexto del request (su deadline incluido). Si el request
+    se cancela o vence mientras el trabajo sigue en cola, se descarta sin ejecutarse.
+
+    Args:
+        func: Función síncrona a ejecutar
+        *args: Argumentos posicionales para func
+        **kwargs: Argumentos con nombre para func
+
+    Returns:
+        El valor devuelto por func
+
+    Raises:
+        DeadlineError: Si el request ya venció o fue cancelado
+    """
+    timeout = remaining_time()
+
+    # Si el request se está perfilando, el trabajo del worker entra en el mismo profile
+    func = wrap_for_profiling(func)
+    context = contextvars.copy_context()
+    future = _executor.submit(context.run, partial(func, *args, **kwargs))
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout)
+    except asyncio.CancelledError:
+        # cancel() solo tiene efecto si el trabajo aún no empezó
+        if future.cancel():
+            metrics.increment("image_jobs_cancelled")
+        raise
+    except asyncio.TimeoutError:
+        if future.done():
+            # TimeoutError lanzado por la propia función, no por el deadline
+            raise
+        if future.cancel():
+            metrics.increment("image_jobs_cancelled")
+        # El timeout es el deadline del request: que llegue como 504, no como 500
+        raise DeadlineExceeded()
@@ -2,150 +2,221 @@
 Servicio de procesamiento de imágenes para crear stickers.
 """
 import io
+import threading
+from typing import Optional
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps
 import cv2
-from rembg import remove
+from rembg import new_session, remove
+
+from app import metrics
+from app.deadline import DeadlineError, check_deadline
+from app.services.caption_renderer import CaptionRenderer
 
 
 class StickerProcessor:
-    """Procesador de imágenes para crear stickers con fondo removido y borde blanco."""
-    
-    def create_sticker(self, image_bytes: bytes) -> bytes:
+    """
+    Procesador de imágenes para crear stickers con fondo removido y borde blanco.
+
+    Todo el pipeline trabaja sobre un único array RGBA (H, W, 4) uint8: la imagen se
+    decodifica una vez, pasa por matting, borde y resize sin re-codificar, y solo se
+    codifica a WEBP al final.
+    """
+
+    def __init__(self, model_name: str = "u2net"):
+        # Renderizador de captions (fuentes y glifos cacheados entre requests)
+        self.caption_renderer = CaptionRenderer()
+
+        # Sesión de rembg (modelo ONNX) creada una sola vez, de forma perezosa;
+        # sin sesión, rembg.remove() carga el modelo en cada llamada
+        self.model_name = model_name
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    def create_sticker(self, image_bytes: bytes, caption: Optional[str] = None) -> bytes:
         """
         Crea un sticker procesando la imagen: quita fondo, añade borde blanco y optimiza.
-        
+
         Args:
             image_bytes: Bytes de la imagen original
-            
+            caption: Texto opcional a dibujar sobre el sticker (estilo meme)
+
         Returns:
             Bytes de la imagen procesada en formato WEBP (512x512px)
         """
         try:
-            # 1. Background Removal usando rembg
-            image_without_bg = remove(image_bytes)
-            
-            # Convertir a PIL Image para procesamiento
-            pil_image = Image.open(io.BytesIO(image_without_bg)).convert("RGBA")
-            
-            # 2. White Border (Stroke) usando OpenCV
-            sticker_with_border = self._add_white_border(pil_image)
-            
-            # 3. Resize/Format: Redimensionar a 512x512px y convertir a WEBP
-            final_sticker = self._resize_and_convert(sticker_with_border)
-            
-            # Convertir a bytes
-            output = io.BytesIO()
-            final_sticker.save(output, format="WEBP", quality=90, method=6)
-            output.seek(0)
-            
-            return output.getvalue()
-            
+            # Única decodificación de la imagen de entrada
+            image = Image.open(io.BytesIO(image_bytes))
+            image = ImageOps.exif_transpose(image)
+
+            sticker = self._process(image, caption)
+
+            check_deadline()
+            return self.encode_webp(sticker)
+
+        except DeadlineError:
+            metrics.increment("image_jobs_aborted")
+            raise
+        except Exception as e:
+            raise Exception(f"Error procesando imagen: {str(e)}")
+
+    def create_sticker_array(self, image: np.ndarray, caption: Optional[str] = None) -> np.ndarray:
+        """
+        Igual que create_sticker pero con arrays, para llamadas dentro del proceso.
+
+        Args:
+            image: Array uint8 (H, W, 3) RGB o (H, W, 4) RGBA
+            caption: Texto opcional a dibujar sobre el sticker (estilo meme)
+
+        Returns:
+            Array RGBA (512, 512, 4) uint8 con el sticker
+        """
+        try:
+            # fromarray comparte la memoria del array (sin copia) para RGB/RGBA contiguos
+            return self._process(Image.fromarray(np.ascontiguousarray(image)), caption)
+
+        except DeadlineError:
+            metrics.increment("image_jobs_aborted")
+            raise
         except Exception as e:
             raise Exception(f"Error procesando imagen: {str(e)}")
-    
-    def _add_white_border(self, image: Image.Image, border_size: int = 10) -> Image.Image:
+
+    def encode_webp(self, sticker: np.ndarray) -> bytes:
+        """
+        Codifica un sticker RGBA a WEBP.
+
+        Args:
+            sticker: Array RGBA (H, W, 4) uint8
+
+        Returns:
+            Bytes WEBP
+        """
+        output = io.BytesIO()
+        Image.fromarray(sticker, mode="RGBA").save(output, format="WEBP", quality=90, method=6)
+        return output.getvalue()
+
+    def _process(self, image: Image.Image, caption: Optional[str]) -> np.ndarray:
+        """
+        Pipeline común: matting, borde, caption opcional y resize.
+
+        Entre etapas se comprueba el deadline del request: si el cliente se fue o el
+        tiempo se agotó, el worker deja de trabajar para nadie.
+        """
+        check_deadline()
+
+        # 1. Background Removal usando rembg (interfaz PIL: sin PNG intermedio)
+        rgba = self._remove_background(image)
+
+        check_deadline()
+
+        # 2. White Border (Stroke) usando OpenCV
+        sticker_with_border = self._add_white_border(rgba)
+
+        # Caption opcional estilo meme: se dibuja in-place sobre el buffer del borde
+        # (recién creado por _add_white_border, así que es escribible y sin copias)
+        if caption:
+            self.caption_renderer.render(sticker_with_border, caption)
+
+        check_deadline()
+
+        # 3. Resize: Redimensionar a 512x512px
+        return self._resize_and_convert(sticker_with_border)
+
+    def _remove_background(self, image: Image.Image) -> np.ndarray:
+        """
+        Quita el fondo con rembg.
+
+        Args:
+            image: Imagen PIL (RGB o RGBA)
+
+        Returns:
+            Array RGBA (H, W, 4) uint8 con el fondo transparente
+        """
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        cutout = remove(image, session=self._get_session())
+        if cutout.mode != "RGBA":
+            cutout = cutout.convert("RGBA")
+        return np.asarray(cutout)
+
+    def _get_session(self):
+        """Devuelve la sesión de rembg, creándola la primera vez."""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = new_session(self.model_name)
+        return self._session
+
+    def _add_white_border(self, image: np.ndarray, border_size: int = 10) -> np.ndarray:
         """
         Añade un borde blanco alrededor de la imagen usando dilatación morfológica.
-        
+
         Args:
-            image: Imagen PIL en formato RGBA
+            image: Array RGBA (H, W, 4) uint8
             border_size: Tamaño del borde en píxeles (dilatación)
-            
+
         Returns:
-            Imagen con borde blanco añadido
+            Array RGBA (H + 2*border_size, W + 2*border_size, 4) con borde blanco añadido
         """
-        # Convertir PIL Image a numpy array
-        img_array = np.array(image)
-        
-        # Extraer canal alfa como máscara
-        alpha_channel = img_array[:, :, 3]
-        
+        height, width = image.shape[:2]
+        alpha_channel = image[:, :, 3]
+
         # Crear kernel morfológico para dilatación (circular para mejor resultado)
         kernel_size = border_size * 2 + 1
         kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size))
-        
-        # Dilatar la máscara alfa (expandir hacia afuera)
-        dilated_mask = cv2.dilate(alpha_channel, kernel, iterations=1)
-        
-        # Crear nueva imagen con fondo blanco del tamaño dilatado
-        new_width = img_array.shape[1] + border_size * 2
-        new_height = img_array.shape[0] + border_size * 2
-        
-        # Calcular offset para centrar la imagen original
-        offset_x = border_size
-        offset_y = border_size
-        
-        # Crear imagen base blanca
-        white_background = np.ones((new_height, new_width, 4), dtype=np.uint8) * 255
-        
-        # Crear máscara expandida para el borde blanco
-        expanded_mask = np.zeros((new_height, new_width), dtype=np.uint8)
-        expanded_mask[offset_y:offset_y + dilated_mask.shape[0], 
-                     offset_x:offset_x + dilated_mask.shape[1]] = dilated_mask
-        
-        # Aplicar máscara expandida al fondo blanco (solo donde hay dilatación)
-        white_background[:, :, 3] = expanded_mask  # Canal alfa
-        
-        # Superponer la imagen original centrada sobre el borde blanco
-        orig_alpha = img_array[:, :, 3]
-        orig_rgb = img_array[:, :, :3]
-        
-        # Crear imagen original con offset
-        orig_with_offset = np.zeros((new_height, new_width, 4), dtype=np.uint8)
-        orig_with_offset[offset_y:offset_y + img_array.shape[0],
-                        offset_x:offset_x + img_array.shape[1], :3] = orig_rgb
-        orig_with_offset[offset_y:offset_y + img_array.shape[0],
-                        offset_x:offset_x + img_array.shape[1], 3] = orig_alpha
-        
-        # Combinar: donde hay imagen original, usar esa; donde solo hay borde, usar blanco
-        result = white_background.copy()
-        
+
+        # Dilatar la máscara alfa ya con el margen, para que el borde pueda salir
+        # de los límites de la imagen original
+        padded_alpha = cv2.copyMakeBorder(
+            alpha_channel, border_size, border_size, border_size, border_size,
+            cv2.BORDER_CONSTANT, value=0
+        )
+        dilated_mask = cv2.dilate(padded_alpha, kernel, iterations=1)
+
+        # Un solo buffer de salida: blanco con el alfa dilatado (el borde)
+        result = np.empty((height + border_size * 2, width + border_size * 2, 4), dtype=np.uint8)
+        result[:, :, :3] = 255
+        result[:, :, 3] = dilated_mask
+
         # Donde hay imagen original (alpha > 0), usar la imagen original
-        orig_mask = orig_with_offset[:, :, 3] > 0
-        result[orig_mask] = orig_with_offset[orig_mask]
-        
-        # Donde solo hay borde (dilatado pero no original), mantener blanco
-        border_mask = (expanded_mask > 0) & (orig_with_offset[:, :, 3] == 0)
-        result[border_mask] = [255, 255, 255, expanded_mask[border_mask]]
-        
-        # Convertir de vuelta a PIL Image
-        result_image = Image.fromarray(result, mode="RGBA")
-        
-        return result_image
-    
-    def _resize_and_convert(self, image: Image.Image, target_size: int = 512) -> Image.Image:
+        inner = result[border_size:border_size + height, border_size:border_size + width]
+        np.copyto(inner, image, where=(alpha_channel > 0)[:, :, None])
+
+        return result
+
+    def _resize_and_convert(self, image: np.ndarray, target_size: int = 512) -> np.ndarray:
         """
         Redimensiona la imagen a tamaño cuadrado manteniendo aspect ratio.
-        
+
         Args:
-            image: Imagen PIL
+            image: Array RGBA (H, W, 4) uint8
             target_size: Tamaño objetivo (512x512)
-            
+
         Returns:
-            Imagen redimensionada con padding blanco si es necesario
+            Array RGBA (target_size, target_size, 4) con padding blanco si es necesario
         """
         # Calcular nuevo tamaño manteniendo aspect ratio
-        width, height = image.size
+        height, width = image.shape[:2]
         max_dim = max(width, height)
-        
+
         if max_dim > target_size:
-            # Reducir proporcionalmente
+            # Reducir proporcionalmente (INTER_AREA: antialiasing al reducir)
             scale = target_size / max_dim
-            new_width = int(width * scale)
-            new_height = int(height * scale)
-            image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            width, height = new_width, new_height
-        
+            width = max(1, int(width * scale))
+            height = max(1, int(height * scale))
+            image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
         # Crear imagen cuadrada con fondo blanco
-        square_image = Image.new("RGBA", (target_size, target_size), (255, 255, 255, 255))
-        
+        square_image = np.full((target_size, target_size, 4), 255, dtype=np.uint8)
+
         # Centrar la imagen en el cuadrado
         offset_x = (target_size - width) // 2
         offset_y = (target_size - height) // 2
-        
-        # Pegar la imagen centrada
-        square_image.paste(image, (offset_x, offset_y), image if image.mode == "RGBA" else None)
-        
-        return square_image
+        region = square_image[offset_y:offset_y + height, offset_x:offset_x + width]
+
+        # Componer sobre el blanco usando el alfa como máscara (como Image.paste con máscara)
+        alpha = image[:, :, 3:4].astype(np.uint16)
+        blended = image.astype(np.uint16) * alpha + 255 * (255 - alpha)
+        region[:] = ((blended + 127) // 255).astype(np.uint8)
 
+        return square_image
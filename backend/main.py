@@ -4,13 +4,20 @@ Aplicación principal FastAPI para MiSticker API.
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.routers import stickers
+from app import metrics
+from app.deadline import DeadlineMiddleware
+from app.profiling import ProfilingMiddleware, profiling_enabled
+from app.routers import blobs, stickers
 
 app = FastAPI(
     title="MiSticker API",
     description="El motor detrás de tus stickers"
 )
 
+# Deadline por request y cancelación si el cliente se desconecta.
+# Se registra antes que CORS para que CORS lo envuelva y el 504 lleve sus headers
+app.add_middleware(DeadlineMiddleware)
+
 # Configurar CORS para permitir requests del frontend
 app.add_middleware(
     CORSMiddleware,
@@ -20,10 +27,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Profiling por request: solo se instala si está configurado (coste cero si no)
+if profiling_enabled():
+    app.add_middleware(ProfilingMiddleware)
+
 # Registrar routers
 app.include_router(stickers.router)
+app.include_router(blobs.router)
 
 # Ruta de prueba para saber que el servidor vive
 @app.get("/")
 async def health_check():
     return {"status": "online", "vibe": "dank"}
+
+
+# Contadores básicos (requests cancelados, trabajos descartados, etc.)
+@app.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()